@@ -15,6 +15,32 @@ except ImportError:
 
 from src_simrareped import VERSION
 
+from distutils.command.build_ext import build_ext
+from distutils.errors import CCompilerError, DistutilsExecError, DistutilsPlatformError
+
+# optional compiled kernels, srv_batch_simrareped falls back to numpy without them
+try:
+    from Cython.Build import cythonize
+    ext_modules = cythonize([Extension('src_simrareped._kernels',
+        sources=['src_simrareped/_kernels.pyx'], language='c++')])
+except ImportError:
+    ext_modules = []
+
+class optional_build_ext(build_ext):
+    '''Build extension modules if possible, skip them (with a warning) if
+    there is no working C++ compiler'''
+    def run(self):
+        try:
+            build_ext.run(self)
+        except (CCompilerError, DistutilsExecError, DistutilsPlatformError) as e:
+            self.warn('Failed to build compiled kernels (%s), numpy will be used instead' % e)
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except (CCompilerError, DistutilsExecError, DistutilsPlatformError) as e:
+            self.warn('Failed to build extension %s (%s), numpy will be used instead' % (ext.name, e))
+
 setup(name = "RarePedSim",
     version = VERSION,
     description = "Simulation framework for generating family-based rare variant data",
@@ -33,8 +59,9 @@ setup(name = "RarePedSim",
 	'src_simrareped.parallel',
     ],
     scripts = ['rarepedsim'],
-    cmdclass = {'build_py': build_py },
+    cmdclass = {'build_py': build_py, 'build_ext': optional_build_ext},
     #package_dir = {'src_simrareped': 'simRarePed'},
     packages = ['src_simrareped'],
+    ext_modules = ext_modules,
     package_data = {}
 )
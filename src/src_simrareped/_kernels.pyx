@@ -0,0 +1,60 @@
+# cython: boundscheck=False, wraparound=False
+# distutils: language = c++
+# $File: _kernels.pyx $
+# $LastChangedDate:  $
+# $Rev:  $
+# This file is part of the RarePedSim program
+# Copyright (c) 2013-2015, Biao Li <libiaospe@gmail.com, biaol@bcm.edu>
+# GNU General Public License (http://www.gnu.org/licenses/gpl.html)
+#
+# Author: Biao Li
+# purpose: compiled kernels used by srv_batch_simrareped if available
+
+from libc.stdint cimport int64_t, uint8_t, uint16_t, uint32_t, uint64_t
+from libcpp.unordered_set cimport unordered_set
+import numpy as np
+
+
+# allele types of simuPOP genotypes (see ALLELE_DTYPE in srv_batch_simrareped),
+# so that genotypes can be passed without conversion
+ctypedef fused allele_t:
+    uint8_t
+    uint16_t
+    uint32_t
+    uint64_t
+    int64_t
+
+
+cpdef count_segsites(const allele_t[::1] geno):
+    '''Return the number of mutants (non-zero alleles) in genotype ``geno``
+    and the number of distinct mutants (segregation sites), counted in a
+    single pass.
+    '''
+    cdef Py_ssize_t i
+    cdef Py_ssize_t numMutants = 0
+    cdef unordered_set[uint64_t] sites
+    for i in range(geno.shape[0]):
+        if geno[i] != 0:
+            numMutants += 1
+            sites.insert(<uint64_t>geno[i])
+    return numMutants, sites.size()
+
+
+cpdef pack_mutants(const int64_t[:, ::1] mutants):
+    '''Move non-zero entries of each row of ``mutants`` to the beginning of
+    the row, keeping their order. Return the packed array and the number of
+    non-zero entries of each row.
+    '''
+    cdef Py_ssize_t i, j, k
+    packed = np.zeros((mutants.shape[0], mutants.shape[1]), dtype=np.int64)
+    lengths = np.zeros(mutants.shape[0], dtype=np.int64)
+    cdef int64_t[:, ::1] out = packed
+    cdef int64_t[::1] lens = lengths
+    for i in range(mutants.shape[0]):
+        k = 0
+        for j in range(mutants.shape[1]):
+            if mutants[i, j] != 0:
+                out[i, k] = mutants[i, j]
+                k += 1
+        lens[i] = k
+    return packed, lengths
@@ -46,6 +46,7 @@
 # rest of the markers.
 #
 
+from __future__ import print_function
 import simuOpt
 simuOpt.setOptions(alleleType='long', optimized=True, quiet=True, version='1.0.5', gui='batch')
 
@@ -54,10 +55,34 @@ from simuPOP.utils import ProgressBar, migrIslandRates
 from simuPOP.sandbox import RevertFixedSites, revertFixedSites, MutSpaceSelector, MutSpaceMutator, MutSpaceRecombinator
 
 import os, sys, logging, math, time, random, tempfile, tarfile, shutil, glob
+from collections import defaultdict
 import numpy as np
+from joblib import Parallel, delayed
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+try:
+    xrange
+except NameError:
+    # Python 3
+    xrange = range
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+try:
+    # compiled kernels, built by setup.py if Cython is available
+    import _kernels
+except ImportError:
+    _kernels = None
 
 from gdata import GData
 
+# wall-clock timer (time.clock measures CPU time on Unix under Python 2 and
+# is removed in Python 3)
+timer = getattr(time, 'perf_counter', time.time)
+
 
 options = [
     {'separator': 'Basics'},
@@ -83,6 +108,33 @@ options = [
      'description': ''' *** Number of Replicates *** ''',
      'type': 'integer',
     },
+    {'name': 'numJobs',
+     'default': 1,
+     'label': '    Number of Jobs',
+     'description': ''' *** Number of Jobs ***
+        |Number of processes (CPUs) used to simulate replicates in parallel.
+        For -1 all CPUs are used; for 1 replicates are simulated one after
+        another; for numbers below -1, CPU#s+1+numJobs are used.''',
+     'type': 'integer',
+    },
+    {'name': 'repID',
+     'default': 0,
+     'label': '    Replicate to Simulate',
+     'description': ''' *** Replicate to Simulate ***
+        |If a positive number K is given, only replicate K is simulated and
+        its output is saved to file *_rep_K.sfs. This allows replicates to be
+        simulated as independent jobs (with the same seed), the output of
+        which can be merged into a single *.sfs file afterwards.''',
+     'type': 'integer',
+    },
+    {'name': 'seed',
+     'default': 0,
+     'label': '    Random Seed',
+     'description': ''' *** Random Seed ***
+        |Seed from which seeds of all replicates are derived. If 0, a random
+        seed from the operating system is used.''',
+     'type': 'integer',
+    },
     {'separator': ''},
     {'separator': 'Demographic Model'},
     {'name': 'N',
@@ -344,6 +396,65 @@ def testProgressBarGUI():
         return False
     
 
+# numpy type of alleles of the loaded simuPOP module
+ALLELE_DTYPE = {255: np.uint8, 65535: np.uint16,
+    4294967295: np.uint32}.get(sim.moduleInfo()['maxAllele'], np.uint64)
+
+
+def genotypeArray(geno):
+    '''Return genotype ``geno`` (a simuPOP carray returned by functions such
+    as ``pop.genotype()`` or ``ind.genotype(p, ch)``) as a numpy array so that
+    it can be processed in bulk instead of element by element in Python. The
+    array is a read-only view of the genotype if the carray exposes the buffer
+    protocol, and a copy otherwise.
+    '''
+    try:
+        arr = np.frombuffer(geno, dtype=ALLELE_DTYPE)
+        if arr.size == len(geno):
+            return arr
+    except (TypeError, ValueError, AttributeError):
+        pass
+    return np.fromiter(geno, dtype=ALLELE_DTYPE, count=len(geno))
+
+
+def genotypeMatrix(pop):
+    '''Return genotypes of all individuals in population ``pop`` as a 3D numpy
+    array indexed by individual, ploidy and locus. Genotypes are retrieved from
+    the population in one pass.
+    '''
+    return genotypeArray(pop.genotype()).reshape(pop.popSize(), 2, pop.totNumLoci())
+
+
+#
+# packMutants(mutants) moves non-zero entries of each row of a 2D array of
+# mutants to the beginning of the row (keeping their order) and returns the
+# packed array and the number of non-zero entries of each row. A compiled
+# kernel is used if numba or the Cython module _kernels is available.
+#
+if njit is None and _kernels is not None:
+    def packMutants(mutants):
+        return _kernels.pack_mutants(np.ascontiguousarray(mutants, dtype=np.int64))
+elif njit is None:
+    def packMutants(mutants):
+        # stable sort puts non-zero entries first without changing their order
+        order = np.argsort(mutants == 0, axis=1, kind='mergesort')
+        packed = mutants[np.arange(mutants.shape[0])[:, np.newaxis], order]
+        return packed, (mutants != 0).sum(axis=1)
+else:
+    @njit(cache=True, parallel=True)
+    def packMutants(mutants):
+        packed = np.zeros_like(mutants)
+        lengths = np.zeros(mutants.shape[0], dtype=np.int64)
+        for i in prange(mutants.shape[0]):
+            k = 0
+            for j in range(mutants.shape[1]):
+                if mutants[i, j] != 0:
+                    packed[i, k] = mutants[i, j]
+                    k += 1
+            lengths[i] = k
+        return packed, lengths
+
+
 class NumSegregationSites(sim.PyOperator):
     '''A Python operator to count the number of segregation sites (number of
     distinct mutants), average number of segreagation sites of individuals,
@@ -357,55 +468,59 @@ class NumSegregationSites(sim.PyOperator):
         '''Count the number of segregation sites, average sites per individual,
         average allele frequency.'''
         revertFixedSites(pop)
-        geno = pop.genotype()
-        numMutants = float(len(geno) - geno.count(0)) 
-        numSites = len(set(geno)) - 1
+        popSize = pop.popSize()
+        geno = genotypeArray(pop.genotype())
+        if _kernels is not None:
+            # the kernel takes genotypes of any allele type without a copy
+            numMutants, numSites = _kernels.count_segsites(geno)
+            numMutants = float(numMutants)
+        else:
+            numMutants = float(np.count_nonzero(geno))
+            # no need to count sites if there is no mutant (e.g. early burn-in generations)
+            numSites = np.unique(geno[geno != 0]).size if numMutants > 0 else 0
         if numMutants == 0:
             avgFreq = 0
         else:
-            avgFreq = numMutants / numSites / (2*pop.popSize())
-        pop.dvars().numSites = numSites
-        pop.dvars().avgSites = float(numMutants) / pop.popSize()
-        pop.dvars().avgFreq = avgFreq
+            avgFreq = numMutants / numSites / (2*popSize)
+        dvars = pop.dvars()
+        dvars.numSites = numSites
+        dvars.avgSites = float(numMutants) / popSize
+        dvars.avgFreq = avgFreq
         return True
 
 def mutantsToAlleles(pop, logger):
     '''Convert a population from mutational space to allele space. Monomorphic
     markers are ignored.
     '''
-    # figure out chromosomes and markers
-    markers = {}
+    # genotypes are read once and used both to find markers and to fill
+    # the populations in allele space
+    genos = genotypeMatrix(pop)
+    popSize = pop.popSize()
+    # group chromosomes by chromosome number
+    chromsOf = defaultdict(list)
     for ch,region in enumerate(pop.chromNames()):
-        chNumber = region.split(':')[0][3:]
-        loci = set()
-        for ind in pop.individuals():
-            loci |= set(ind.genotype(0, ch))
-            loci |= set(ind.genotype(1, ch))
-        if markers.has_key(chNumber):
-            markers[chNumber] |= loci
-        else:
-            markers[chNumber] = loci
+        chromsOf[region.split(':')[0][3:]].append(ch)
     # create a population for each chromosome
     pops = []
-    chroms = markers.keys()
-    chroms.sort()
-    for ch in chroms:
-        markers[ch] = list(markers[ch])
-        markers[ch].remove(0)
-        markers[ch].sort()
+    for ch in sorted(chromsOf.keys()):
+        cols = np.concatenate([np.arange(pop.chromBegin(x), pop.chromEnd(x))
+            for x in chromsOf[ch]])
+        chGenos = genos[:, :, cols]
+        # figure out markers in one pass, allele 0 is fake
+        markers = np.unique(chGenos)
+        markers = markers[markers != 0]
         if logger:
-            logger.info('Chromosome %s has %d markers' % (ch, len(markers[ch])))
-        apop = sim.Population(pop.popSize(), loci=len(markers[ch]),
-            lociPos=markers[ch])
-        # get a dictionary of loci position
-        lociPos = {}
-        for idx,loc in enumerate(apop.lociPos()):
-            lociPos[loc] = idx
-        for aind,mind in zip(apop.individuals(), pop.individuals()):
+            logger.info('Chromosome %s has %d markers' % (ch, len(markers)))
+        apop = sim.Population(popSize, loci=len(markers),
+            lociPos=markers.tolist())
+        for idx,aind in enumerate(apop.individuals()):
             for p in range(2):
-                for mutant in mind.genotype(p):
-                    if mutant != 0:
-                        aind.setAllele(1, lociPos[mutant], p)
+                mutants = chGenos[idx, p]
+                mutants = mutants[mutants != 0]
+                # sorted markers give the index of each mutant
+                geno = np.zeros(len(markers), dtype=np.int64)
+                geno[np.searchsorted(markers, mutants)] = 1
+                aind.setGenotype(geno.tolist(), p)
         pops.append(apop)
     for pop in pops[1:]:
         pops[0].addChromFrom(pop)
@@ -417,43 +532,34 @@ def allelesToMutants(pop, regions, logger=None):
     specified regions.
     '''
     pops = []
+    popSize = pop.popSize()
+    # positions and genotypes of all loci, retrieved once
+    allPos = np.array(pop.lociPos(), dtype=np.float64)
+    genos = genotypeMatrix(pop)
     for region in regions:
-        loci = []
         ch_name = region.split(':')[0][3:]
         start, end = [int(x) for x in region.split(':')[1].split('..')]
         try:
             ch = pop.chromByName(ch_name)
         except:
             raise ValueError('Chromosome %s is not available in passed population.' % ch_name)
-        for loc in range(pop.chromBegin(ch), pop.chromEnd(ch)):
-            pos = pop.locusPos(loc)
-            if pos >= start and pos <= end:
-                loci.append(loc)
-        # get the mutants for each individual
-        allAlleles = []
-        for ind in pop.individuals():
-            alleles0 = []
-            alleles1 = []
-            for loc in loci:
-                if ind.allele(loc, 0) != 0:
-                    alleles0.append(int(pop.locusPos(loc)))
-                if ind.allele(loc, 1) != 0:
-                    alleles1.append(int(pop.locusPos(loc)))
-            allAlleles.extend([alleles0, alleles1])
+        chBegin = pop.chromBegin(ch)
+        chPos = allPos[chBegin:pop.chromEnd(ch)]
+        loci_arr = chBegin + np.nonzero((chPos >= start) & (chPos <= end))[0]
+        loci = loci_arr.tolist()
+        pos_arr = allPos[loci_arr].astype(np.int64)
+        # get the mutants for each individual, one row per haplotype
+        haps = genos[:, :, loci_arr].reshape(2*popSize, len(loci))
+        allAlleles, numMutants = packMutants(np.where(haps != 0, pos_arr, 0))
         # maximum number of mutants
-        maxMutants = max([len(x) for x in allAlleles])
+        maxMutants = int(numMutants.max())
         if logger is not None:
             logger.info('%d loci are identified with at most %d mutants in region %s.' % (len(loci), maxMutants, region))
         # create a population
-        mpop = sim.Population(pop.popSize(), loci=maxMutants, chromNames=region)
-        # put in mutants
-        for idx,ind in enumerate(mpop.individuals()):
-            geno = ind.genotype(0)
-            for loc,mut in enumerate(allAlleles[idx*2]):
-                geno[loc] = mut
-            geno = ind.genotype(1)
-            for loc,mut in enumerate(allAlleles[idx*2+1]):
-                geno[loc] = mut
+        mpop = sim.Population(popSize, loci=maxMutants, chromNames=region)
+        # put in mutants, rows are ordered by individual and then ploidy
+        if maxMutants > 0:
+            mpop.setGenotype(allAlleles[:, :maxMutants].ravel().tolist())
         pops.append(mpop)
     # merge all populations into one
     for pop in pops[1:]:
@@ -476,119 +582,22 @@ def addMutantsFrom(pop, param):
         # if an initial population is given
         logger.info('Adding mutants to population after bottleneck')
     # Add mutants to pop
-    for ind, mInd in zip(pop.individuals(), mPop.individuals()):
-        for p in range(2):
-            for ch in range(pop.numChrom()):
-                geno = ind.genotype(p, ch)
-                mGeno = mInd.genotype(p, ch)
-                idx = geno.index(0)
-                for i,m in enumerate(mGeno):
-                    if m == 0:
-                        break
-                    geno[idx + i] = m
+    genos = genotypeMatrix(pop)
+    mGenos = genotypeMatrix(mPop)
+    individuals = list(pop.individuals())
+    for ch in range(pop.numChrom()):
+        # mutants are appended after the first empty (0) slot of each haplotype
+        first = (genos[:, :, pop.chromBegin(ch):pop.chromEnd(ch)] == 0).argmax(axis=2)
+        chMGenos = mGenos[:, :, mPop.chromBegin(ch):mPop.chromEnd(ch)]
+        for idx, ind in enumerate(individuals):
+            for p in range(2):
+                mGeno = chMGenos[idx, p]
+                mGeno = mGeno[mGeno != 0]
+                start = int(first[idx, p])
+                ind.genotype(p, ch)[start:start + mGeno.size] = mGeno.tolist()
     return True
 
 
-###
-### The container.Counter class only exist in Python 2.7 so I put it here
-###
-from operator import itemgetter
-from heapq import nlargest
-from itertools import repeat, ifilter
-
-class Counter(dict):
-    '''Dict subclass for counting hashable objects.  Sometimes called a bag
-    or multiset.  Elements are stored as dictionary keys and their counts
-    are stored as dictionary values.
-
-    >>> Counter('zyzygy')
-    Counter({'y': 3, 'z': 2, 'g': 1})
-
-    '''
-
-    def __init__(self, iterable=None, **kwds):
-        '''Create a new, empty Counter object.  And if given, count elements
-        from an input iterable.  Or, initialize the count from another mapping
-        of elements to their counts.
-
-        >>> c = Counter()                           # a new, empty counter
-        >>> c = Counter('gallahad')                 # a new counter from an iterable
-        >>> c = Counter({'a': 4, 'b': 2})           # a new counter from a mapping
-        >>> c = Counter(a=4, b=2)                   # a new counter from keyword args
-
-        '''        
-        self.update(iterable, **kwds)
-
-    def __missing__(self, key):
-        return 0
-
-
-    def elements(self):
-        '''Iterator over elements repeating each as many times as its count.
-
-        >>> c = Counter('ABCABC')
-        >>> sorted(c.elements())
-        ['A', 'A', 'B', 'B', 'C', 'C']
-
-        If an element's count has been set to zero or is a negative number,
-        elements() will ignore it.
-
-        '''
-        for elem, count in self.iteritems():
-            for _ in repeat(None, count):
-                yield elem
-
-    # Override dict methods where the meaning changes for Counter objects.
-
-    @classmethod
-    def fromkeys(cls, iterable, v=None):
-        raise NotImplementedError(
-            'Counter.fromkeys() is undefined.  Use Counter(iterable) instead.')
-
-    def update(self, iterable=None, **kwds):
-        '''Like dict.update() but add counts instead of replacing them.
-
-        Source can be an iterable, a dictionary, or another Counter instance.
-
-        >>> c = Counter('which')
-        >>> c.update('witch')           # add elements from another iterable
-        >>> d = Counter('watch')
-        >>> c.update(d)                 # add elements from another counter
-        >>> c['h']                      # four 'h' in which, witch, and watch
-        4
-
-        '''        
-        if iterable is not None:
-            if hasattr(iterable, 'iteritems'):
-                if self:
-                    self_get = self.get
-                    for elem, count in iterable.iteritems():
-                        self[elem] = self_get(elem, 0) + count
-                else:
-                    dict.update(self, iterable) # fast path when counter is empty
-            else:
-                self_get = self.get
-                for elem in iterable:
-                    self[elem] = self_get(elem, 0) + 1
-        if kwds:
-            self.update(kwds)
-
-    def __delitem__(self, elem):
-        'Like dict.__delitem__() but does not raise KeyError for missing values.'
-        if elem in self:
-            dict.__delitem__(self, elem)
-
-    def __repr__(self):
-        if not self:
-            return '%s()' % self.__class__.__name__
-        items = ', '.join(map('%r: %r'.__mod__, self.most_common()))
-        return '%s({%s})' % (self.__class__.__name__, items)
- 
-#
-# End of copied code
-#
-
-
 #def saveMarkerInfoToFile(pop, filename, logger=None):
 #    '''Save a map file with an additional column of allele frequency. The
 #    population has to be in mutational space. This function assumes that
@@ -634,75 +643,130 @@ class Counter(dict):
 #    return allMutants
         
 
-def saveMarkerInfoToFile(pop, fileName, regInt, replicate, logger=None):
+def saveMarkerInfoToFile(pop, fileName, regInt, replicate, logger=None, selTable=None):
     '''Save a map file with an additional column of allele frequency. The
     population has to be in mutational space. This function assumes that
     there is a variable selCoef in this population which contains selection
-    coefficients for all mutants.
+    coefficients for all mutants, unless a table (start, selS) of selection
+    coefficients indexed by position - start is given by ``selTable``.
+    Marker information is appended to fileName.sfs, or written to fileName if
+    it is an opened file.
     '''
-    allCounts = [Counter() for x in range(pop.numChrom())]
-    prog = ProgressBar('Counting number of mutants for replicate %d' % replicate, pop.popSize(), gui=testProgressBarGUI())
-    for ind in pop.individuals():
-        # there can be memory problem....
-        for ch in range(pop.numChrom()):
-            allCounts[ch].update(ind.genotype(0, ch))
-            allCounts[ch].update(ind.genotype(1, ch))
-        prog.update()
+    genos = genotypeMatrix(pop)
+    sz = pop.popSize() * 2.
     allMutants = []
     selCoefficient = pop.dvars().selCoef
-    outFile = open(fileName+'.sfs', 'a')
+    if selTable is None and type(selCoefficient) == type({}):
+        # selection coefficients of all mutants as sorted parallel arrays
+        selKeys = np.array(sorted(selCoefficient.keys()), dtype=np.int64)
+        selS = np.array([selCoefficient[k][0] for k in selKeys.tolist()], dtype=np.float64)
+    # output of this replicate is buffered and written to *.sfs file at once
+    outFile = StringIO()
     # write gene length to *.sfs file
-    print >> outFile, '# Replicate #%d gene length = %d' % (replicate, regInt)
-    maf, sel, pos, vaf = [],[],[],[]
+    print('# Replicate #%d gene length = %d' % (replicate, regInt), file=outFile)
+    mafList, selList, vafList = [], [], []
     # write maf, sel and pos info into *.sfs file
+    name = ('R'+str(replicate)) if replicate>=1 else getattr(fileName, 'name', fileName)
     for ch,region in enumerate(pop.chromNames()):
         # real chromosome number
         chName = region.split(':')[0][3:]
-        counts = allCounts[ch]
-        # get markers
-        mutants = counts.keys()
-        mutants.sort()
-        # allele 0 is fake
-        if mutants[0] == 0:
-            mutants = mutants[1:]
+        # get markers (sorted) and their counts, allele 0 is fake and is
+        # removed before sorting
+        chromGenos = genos[:, :, pop.chromBegin(ch):pop.chromEnd(ch)]
+        mutants, counts = np.unique(chromGenos[chromGenos != 0], return_counts=True)
         allMutants.append(mutants)
         # write to file
-        sz = pop.popSize() * 2.
-        for idx2, marker in enumerate(mutants):
-            # vaf - variant allele frequency
-            # maf - minor allele frequency
-            vaf_marker = counts[marker] / sz
-            maf_marker = vaf_marker if vaf_marker <= 0.5 else 1-vaf_marker
-            print >> outFile, ' '.join([('R'+str(replicate)) if replicate>=1 else fileName, '%s' % chName+'-'+str(replicate), '%d' % marker, '%.8f' % maf_marker, '%.8f' % selCoefficient[marker][0]])
-            maf.append(round(maf_marker, 8))
-            sel.append(round(selCoefficient[marker][0], 8))
-            pos.append(int(marker))
-            vaf.append(round(vaf_marker, 8))
-    outFile.close()    
+        # vaf - variant allele frequency
+        # maf - minor allele frequency
+        vafs = counts / sz
+        mafs = np.minimum(vafs, 1 - vafs)
+        if selTable is not None:
+            keys = mutants.astype(np.int64)
+            idx = keys - selTable[0]
+            # mutants outside of the table or without selection coefficient
+            missing = (idx < 0) | (idx >= len(selTable[1]))
+            missing[~missing] = np.isnan(selTable[1][idx[~missing]])
+            if missing.any():
+                raise KeyError('No selection coefficient for mutant(s) %s' % ', '.join(map(str, keys[missing][:10].tolist())))
+            sels = selTable[1][idx]
+        elif type(selCoefficient) == type({}):
+            keys = mutants.astype(np.int64)
+            idx = np.searchsorted(selKeys, keys)
+            # mutants without selection coefficient
+            missing = idx >= len(selKeys)
+            missing[~missing] = selKeys[idx[~missing]] != keys[~missing]
+            if missing.any():
+                raise KeyError('No selection coefficient for mutant(s) %s' % ', '.join(map(str, keys[missing][:10].tolist())))
+            sels = selS[idx]
+        else:
+            sels = np.zeros(len(mutants)) + selCoefficient
+        # name and chromosome columns are the same for all markers
+        prefix = ('%s %s-%d ' % (name, chName, replicate)).replace('%', '%%')
+        np.savetxt(outFile, np.column_stack([mutants, mafs, sels]),
+            fmt=[prefix + '%d', '%.8f', '%.8f'])
+        mafList.append(mafs)
+        selList.append(sels)
+        vafList.append(vafs)
+    # rounded values of all chromosomes
+    maf = np.round(np.concatenate(mafList), 8).tolist() if mafList else []
+    sel = np.round(np.concatenate(selList), 8).tolist() if selList else []
+    pos = np.concatenate(allMutants).tolist() if allMutants else []
+    vaf = np.round(np.concatenate(vafList), 8).tolist() if vafList else []
+    if hasattr(fileName, 'write'):
+        fileName.write(outFile.getvalue())
+    else:
+        with open(fileName+'.sfs', 'a') as sfsFile:
+            sfsFile.write(outFile.getvalue())
+    outFile.close()
     return allMutants, maf, sel, pos, vaf
 
 
+# buffer size of output files, and number of individuals whose output is
+# accumulated in memory before it is written to file
+BUFFER_SIZE = 1 << 20
+BUFFER_INDS = 4096
+
+
 def saveMutantsToFile(pop, filename, infoFields=[], logger=None):
     '''Save haplotypes as a list of mutant locations to file, in the format of
        ind_idx reg_id FIELDS mut1 mut2 ...
     where FIELDS are information fields.
     '''
-    mut = open(filename, 'w')
-    prog = ProgressBar('Writing mutants of %d individuals to %s' % (pop.popSize(), filename), pop.popSize(), gui=testProgressBarGUI())
+    mut = open(filename, 'w', BUFFER_SIZE)
+    lines = []
+    popSize = pop.popSize()
+    numLoci = pop.totNumLoci()
+    chromRanges = [(pop.chromBegin(ch), pop.chromEnd(ch)) for ch in range(pop.numChrom())]
+    prog = ProgressBar('Writing mutants of %d individuals to %s' % (popSize, filename), popSize, gui=testProgressBarGUI())
     for idx,ind in enumerate(pop.allIndividuals()):
         fields = ' '.join([str(ind.info(x)) for x in infoFields])
-        for ch in range(pop.numChrom()):
-            geno = list(ind.genotype(0, ch))
-            geno.sort()
-            print >> mut, idx+1, fields, ' '.join([str(x) for x in geno if x != 0])
-            geno = list(ind.genotype(1, ch))
-            geno.sort()
-            if geno[0] == 0:
-                geno = geno[1:]
-            print >> mut, idx+1, fields, ' '.join([str(x) for x in geno if x != 0])
+        # read both ploidies of all chromosomes at once
+        genotype = genotypeArray(ind.genotype()).reshape(2, numLoci)
+        for begin, end in chromRanges:
+            # sort both ploidies together; mutants follow the zeros (no mutant)
+            geno = np.sort(genotype[:, begin:end], axis=1)
+            numZeros = (geno == 0).sum(axis=1)
+            for p in range(2):
+                lines.append('%d %s %s\n' % (idx+1, fields, ' '.join(map(str, geno[p, numZeros[p]:].tolist()))))
+        # lines has 2 x numChrom entries per individual
+        if (idx+1) % BUFFER_INDS == 0:
+            mut.write(''.join(lines))
+            lines = []
         prog.update()
+    mut.write(''.join(lines))
     mut.close()
 
+def genotypeString(geno):
+    '''Return 0/1 genotype ``geno`` (a uint8 array) as space separated digits.
+    Characters are produced by numpy instead of calling str() on each allele.
+    '''
+    if geno.size == 0:
+        return ''
+    chars = np.full(2*geno.size - 1, ord(' '), dtype=np.uint8)
+    chars[0::2] = geno + ord('0')
+    return chars.tobytes().decode('ascii')
+
+
 def saveGenotypeToFile(pop, filename, allMutants, logger=None):
     '''Save genotype in .ped file format. Because there is no family structure, we have
         famid = 1, 2, 3, ...
@@ -719,56 +783,79 @@ def saveGenotypeToFile(pop, filename, allMutants, logger=None):
     if filename != '':
         if logger:
             logger.info('Saving genotype to %s in standard .ped format.' % filename)
-        ped = open(filename, 'w')
-    # marker index...
-    markerPos = []
-    for mutants in allMutants:
-        pos = {}
-        for idx,m in enumerate(mutants):
-            pos[m] = idx
-        markerPos.append(pos)
+        ped = open(filename, 'w', BUFFER_SIZE)
+        lines = []
+    # sorted marker locations of each chromosome, so that the column of a
+    # mutant can be found by binary search
+    allMutants = [np.sort(np.asarray(mutants, dtype=np.int64)) for mutants in allMutants]
+    popSize = pop.popSize()
+    numChrom = pop.numChrom()
     if filename != '':
-        prog = ProgressBar('Writing genotype of %d individuals to %s' % (pop.popSize(), filename), pop.popSize(), gui=testProgressBarGUI())
+        prog = ProgressBar('Writing genotype of %d individuals to %s' % (popSize, filename), popSize, gui=testProgressBarGUI())
     #prog = ProgressBar('Writing genotype of %d individuals to %s' % (pop.popSize(), filename), pop.popSize(), gui=False)
     sexCode = {sim.MALE: 1, sim.FEMALE: 2}
     affCode = {False: 1, True: 2}
+    # genotypes of all individuals, one block for each chromosome, filled
+    # from genotypes of the whole population that are read at once
+    popGenos = genotypeMatrix(pop)
+    genoBlocks = []
+    for ch in range(numChrom):
+        block = np.zeros((popSize, 2*len(allMutants[ch])), dtype=np.uint8)
+        chromGenos = popGenos[:, :, pop.chromBegin(ch):pop.chromEnd(ch)]
+        # individual and ploidy of each mutant
+        inds, ploidy, loci = np.nonzero(chromGenos)
+        # add 1 according to mutant locations (columns 2i and 2i+1 for
+        # the first and second ploidy of marker i)
+        cols = np.searchsorted(allMutants[ch], chromGenos[inds, ploidy, loci].astype(np.int64))
+        block[inds, 2*cols + ploidy] = 1
+        genoBlocks.append(block)
     genos = []
     for cnt, ind in enumerate(pop.individuals()):
         if filename != '':
-            print >> ped, '%s 0 0 0 %d %d' % (cnt + 1, sexCode[ind.sex()], affCode[ind.affected()]),
-        for ch in range(pop.numChrom()):
-            # a blank genotype
-            geno = [0]*(len(markerPos[ch])*2)
-            # add 1 according to mutant location (first ploidy)
-            for m in ind.genotype(0, ch):
-                if m == 0:
-                    break
-                geno[2*markerPos[ch][m]] = 1
-            # add 1 according to mutant location (second ploidy)
-            for m in ind.genotype(1, ch):
-                if m == 0:
-                    break
-                geno[2*markerPos[ch][m]+1] = 1
+            line = ['%s 0 0 0 %d %d' % (cnt + 1, sexCode[ind.sex()], affCode[ind.affected()])]
+        for ch in range(numChrom):
+            geno = genoBlocks[ch][cnt]
             genos.append(geno)
             if filename != '':
-                print >> ped, ' '.join([str(x) for x in geno]),
-        if filename != '':        
-            print >> ped
+                line.append(genotypeString(geno))
+        if filename != '':
+            lines.append(' '.join(line) + '\n')
+            if len(lines) >= BUFFER_INDS:
+                ped.write(''.join(lines))
+                lines = []
             prog.update()
     if filename != '':
+        ped.write(''.join(lines))
         ped.close()
     return genos
 
 class fitnessCollector:
     '''This is a simple connection class that gets output from 
     a InfSiteSelector and collect mutant fitness'''
-    def __init__(self):
+    def __init__(self, ranges=[]):
         self.selCoef = {}
+        # selection coefficients of mutants at positions [start, end) of the
+        # simulated regions, indexed by position - start (nan if unknown).
+        # There is no such table if ranges are not given.
+        if ranges:
+            self.start = min([x[0] for x in ranges])
+            self.selS = np.full(max([x[1] for x in ranges]) - self.start, np.nan)
+        else:
+            self.start, self.selS = 0, None
 
     def getCoef(self, lines):
-        for line in lines.strip().split('\n'):
-            mut, sel, h = line.split()
-            self.selCoef[int(mut)] = float(sel), float(h)
+        # each line has fields mutant, s and h, which are parsed at once
+        values = np.array(lines.split(), dtype=np.float64).reshape(-1, 3)
+        if values.shape[0] == 0:
+            return
+        muts = values[:, 0].astype(np.int64)
+        if self.selS is not None:
+            idx = muts - self.start
+            outside = (idx < 0) | (idx >= len(self.selS))
+            if outside.any():
+                raise ValueError('Mutant(s) %s outside of simulated regions' % ', '.join(map(str, muts[outside][:10].tolist())))
+            self.selS[idx] = values[:, 1]
+        self.selCoef.update(zip(muts.tolist(), zip(values[:, 1].tolist(), values[:, 2].tolist())))
 
 
 #def mixedGamma(selCoef):
@@ -795,17 +882,21 @@ def mixedGamma5(selCoef, selRange):
     '''
     selCoef : [p,s,k,d,h], binned at [selRange[0], selRange[1]]
     '''
+    # parameters and RNG methods are looked up once, not once per mutant
+    p, s0, k, d, h = selCoef
+    lo, hi = selRange
+    rng = sim.getRNG()
+    uni, gam = rng.randUniform, rng.randGamma
     def func():
-        if sim.getRNG().randUniform() < selCoef[0]:
-            return selCoef[1], selCoef[4]
-        while True:
-            s = sim.getRNG().randGamma(selCoef[2], selCoef[3])
-            if s < selRange[0]:
-                return selRange[0], selCoef[4]
-            elif s > selRange[1]:
-                return selRange[1], selCoef[4]
-            else:
-                return s, selCoef[4]
+        if uni() < p:
+            return s0, h
+        s = gam(k, d)
+        if s < lo:
+            return lo, h
+        elif s > hi:
+            return hi, h
+        else:
+            return s, h
     #
     return func
 
@@ -814,18 +905,22 @@ def mixedGamma7(selCoef, selRange):
     '''
     selCoef : [p,s,k,d,h,l,u], truncated at [l, u], binned at [selRange[0], selRange[1]]
     '''
+    p, s0, k, d, h, l, u = selCoef
+    lo, hi = selRange
+    rng = sim.getRNG()
+    uni, gam = rng.randUniform, rng.randGamma
     def func():
-        if sim.getRNG().randUniform() < selCoef[0]:
-            return selCoef[1], selCoef[4]
+        if uni() < p:
+            return s0, h
         while True:
-            s = sim.getRNG().randGamma(selCoef[2], selCoef[3])
-            if selCoef[5] < s < selCoef[6]:
-                if s < selRange[0]:
-                    return selRange[0], selCoef[4]
-                elif s > selRange[1]:
-                    return selRange[1], selCoef[4]
+            s = gam(k, d)
+            if l < s < u:
+                if s < lo:
+                    return lo, h
+                elif s > hi:
+                    return hi, h
                 else:
-                    return s, selCoef[4]
+                    return s, h
     #
     return func
 
@@ -838,28 +933,31 @@ def complexMixedGamma8(selCoef, selRange):
         distribution with shape/scale parameters k1/d1, therefore, the probability of having selection coefficient following a negative/opposite gamma distribution is 1-p-q. The negative gamma distribution takes parameters k2 and d2. Note that the generated selection coefficient for the negative gamma distribution will be returned as its opposite number. h is the dominance coefficient (h=0.5 by default)
     By default truncate at both [selRange[0], selRange[1]] and [-selRange[1], -selRange[0]]
     '''
+    p, s0, q, k1, d1, k2, d2, h = selCoef
+    pq = p + q
+    lo, hi = selRange
+    rng = sim.getRNG()
+    uni, gam = rng.randUniform, rng.randGamma
     def func():
-        randNum = sim.getRNG().randUniform()
-        if randNum < selCoef[0]:
-            return selCoef[1], selCoef[7]
-        elif randNum < selCoef[0] + selCoef[2]:
-            while True:
-                s = sim.getRNG().randGamma(selCoef[3], selCoef[4])
-                if s < selRange[0]:
-                    return selRange[0], selCoef[7]
-                elif s > selRange[1]:
-                    return selRange[1], selCoef[7]
-                else:
-                    return s, selCoef[7]
+        randNum = uni()
+        if randNum < p:
+            return s0, h
+        elif randNum < pq:
+            s = gam(k1, d1)
+            if s < lo:
+                return lo, h
+            elif s > hi:
+                return hi, h
+            else:
+                return s, h
         else:
-            while True:
-                s = sim.getRNG().randGamma(selCoef[5], selCoef[6])
-                if s < selRange[0]:
-                    return -selRange[0], selCoef[7]
-                elif s > selRange[1]:
-                    return -selRange[1], selCoef[7]
-                else:
-                    return -s, selCoef[7]
+            s = gam(k2, d2)
+            if s < lo:
+                return -lo, h
+            elif s > hi:
+                return -hi, h
+            else:
+                return -s, h
     #
     return func
     
@@ -868,30 +966,35 @@ def complexMixedGamma12(selCoef, selRange):
     '''
     [p,s,q,k1,d1,k2,d2,h,l1,u1,l2,u2]
     '''
+    p, s0, q, k1, d1, k2, d2, h, l1, u1, l2, u2 = selCoef
+    pq = p + q
+    lo, hi = selRange
+    rng = sim.getRNG()
+    uni, gam = rng.randUniform, rng.randGamma
     def func():
-        randNum = sim.getRNG().randUniform()
-        if randNum < selCoef[0]:
-            return selCoef[1], selCoef[7]
-        elif randNum < selCoef[0] + selCoef[2]:
+        randNum = uni()
+        if randNum < p:
+            return s0, h
+        elif randNum < pq:
             while True:
-                s = sim.getRNG().randGamma(selCoef[3], selCoef[4])
-                if selCoef[8] < s < selCoef[9]:
-                    if s < selRange[0]:
-                        return selRange[0], selCoef[7]
-                    elif s > selRange[1]:
-                        return selRange[1], selCoef[7]
+                s = gam(k1, d1)
+                if l1 < s < u1:
+                    if s < lo:
+                        return lo, h
+                    elif s > hi:
+                        return hi, h
                     else:
-                        return s, selCoef[7]
+                        return s, h
         else:
             while True:
-                s = sim.getRNG().randGamma(selCoef[5], selCoef[6])
-                if selCoef[10] < s < selCoef[11]:
-                    if s < selRange[0]:
-                        return -selRange[0], selCoef[7]
-                    elif s > selRange[1]:
-                        return -selRange[1], selCoef[7]
+                s = gam(k2, d2)
+                if l2 < s < u2:
+                    if s < lo:
+                        return -lo, h
+                    elif s > hi:
+                        return -hi, h
                     else:
-                        return -s, selCoef[7]
+                        return -s, h
     #
     return func
 
@@ -923,35 +1026,88 @@ def genSelDistFunc(selCoef, selRange):
         
     
 
-def multiStageDemoFunc(N, G, splitTo, splitAt):
-    '''Return a demographic function with specified parameter
+# selection samplers, stage boundaries, demographic functions and migration
+# rates, shared by all replicates that are simulated with the same parameters
+_selDistCache = {}
+_stageGensCache = {}
+_demoFuncCache = {}
+_migrRatesCache = {}
+
+def cachedSelDistFunc(selCoef, selRange):
+    '''Return genSelDistFunc(selCoef, selRange), building it only once for
+    each combination of selCoef and selRange
+    '''
+    key = (tuple(selCoef), tuple(selRange))
+    if key not in _selDistCache:
+        _selDistCache[key] = genSelDistFunc(list(selCoef), list(selRange))
+    return _selDistCache[key]
+
+
+def stageGens(G):
+    '''Return the starting generations of all stages, namely
+    [0, G[0], G[0] + G[1], ..., sum(G)]
+    '''
+    key = tuple(G)
+    if key not in _stageGensCache:
+        Gens = [0]
+        for g in G:
+            Gens.append(Gens[-1] + g)
+        _stageGensCache[key] = Gens
+    return list(_stageGensCache[key])
+
+
+def cachedDemoFunc(N, G, splitTo, splitAt, Gens=None):
+    '''Return multiStageDemoFunc(N, G, splitTo, splitAt, Gens), building it
+    only once for each demographic model
+    '''
+    key = (tuple(N), tuple(G), tuple(splitTo), splitAt)
+    if key not in _demoFuncCache:
+        _demoFuncCache[key] = multiStageDemoFunc(list(N), list(G), list(splitTo), splitAt, Gens)
+    return _demoFuncCache[key]
+
+
+def cachedMigrRates(migrRate, n):
+    '''Return migrIslandRates(migrRate, n), computed only once for each
+    combination of migrRate and n
+    '''
+    key = (migrRate, n)
+    if key not in _migrRatesCache:
+        _migrRatesCache[key] = migrIslandRates(migrRate, n)
+    return _migrRatesCache[key]
+
+
+def multiStageDemoFunc(N, G, splitTo, splitAt, Gens=None):
+    '''Return a demographic function with specified parameter. Starting
+    generations of stages (stageGens(G)) can be passed by Gens if they are
+    already known.
     '''
     # the demographic model: N[0] = the population size of the burnin generation
     # 0,    G[0], G[0] + G[1], ..., reflexting
     # N[0], N[1], N[2], ....
-    Gens = [sum(G[:i]) for i in range(len(G)+1)]
+    if Gens is None:
+        Gens = stageGens(G)
+    # stage of each generation, and growth rate of each expansion stage
+    # (stages of zero generations are never entered)
+    stageOf = np.repeat(np.arange(len(G), dtype=np.int32), G)
+    rates = [math.log(N[i+1] * 1.0 / N[i]) / G[i] if N[i] < N[i+1] and G[i] > 0 else 0.
+        for i in range(len(G))]
     #
     def demoFunc(gen, pop):
         if len(splitTo) > 1 and gen == splitAt:
             pop.splitSubPop(0, splitTo)
         nSP = pop.numSubPop()
-        # default
-        sz = N[-1]
-        for i in range(len(G)):
-            if Gens[i] <= gen < Gens[i+1]:
-                # at constant or any bottleneck stage
-                if N[i] >= N[i+1]:
-                    sz = N[i+1]
-                # at any expansion stage
-                else:
-                    # to make sure that the last generation of this expansion stage 
-                    # has the exact required number of individuals.
-                    if gen == Gens[i+1] - 1:
-                        sz = N[i+1]
-                    else:
-                        r = math.log(N[i+1] * 1.0 / N[i]) / G[i]
-                        sz = int(N[i] * math.exp(r*(gen - Gens[i])))
-                break
+        if gen >= len(stageOf):
+            # default
+            sz = N[-1]
+        else:
+            i = stageOf[gen]
+            # at constant or any bottleneck stage, or the last generation of
+            # an expansion stage, which has the exact required number of individuals
+            if N[i] >= N[i+1] or gen == Gens[i+1] - 1:
+                sz = N[i+1]
+            # at any expansion stage
+            else:
+                sz = int(N[i] * math.exp(rates[i]*(gen - Gens[i])))
         # because population might be split, ..
         if nSP == 1:
             return sz
@@ -1012,7 +1168,7 @@ def simuRareVariants(regions, N, G, mu, revertFixedSites, selDist, selCoef,
         # save step for each stage
         steps = steps * len(G)
     # use a right selection operator.
-    collector = fitnessCollector()
+    collector = fitnessCollector(ranges)
     mode = {'multiplicative': sim.MULTIPLICATIVE,
         'additive': sim.ADDITIVE,
         'exponential': sim.EXPONENTIAL}[selModel]
@@ -1023,7 +1179,7 @@ def simuRareVariants(regions, N, G, mu, revertFixedSites, selDist, selCoef,
     if callable(selDist):
         mySelector = MutSpaceSelector(selDist=selDist, mode=mode, output=collector.getCoef)
     else:
-        mySelector = MutSpaceSelector(selDist=genSelDistFunc(selCoef, selRange),
+        mySelector = MutSpaceSelector(selDist=cachedSelDistFunc(selCoef, selRange),
                                       mode=mode, output=collector.getCoef)
     #
     # Evolve
@@ -1041,158 +1197,84 @@ def simuRareVariants(regions, N, G, mu, revertFixedSites, selDist, selCoef,
         pop = sim.Population(size=N[0], loci=[10]*len(regions), chromNames=regions,
             infoFields=['fitness', 'migrate_to'])
     if logger:
-        startTime = time.clock()
+        startTime = timer()
     #
     progGen = []
     # 0, G[0], G[0]+G[1], ..., sum(G)
-    Gens = [sum(G[:i]) for i in range(len(G)+1)]
+    Gens = stageGens(G)
     for i in range(len(Gens)-1):
-        progGen += range(Gens[i], Gens[i+1], steps[i])
-    # if 'revertFixedSites is True', revert alleles at fixed loci to wildtype
-    if revertFixedSites:
-        pop.evolve(
-            initOps=sim.InitSex(),
-            preOps=
-            #[
-    #            sim.PyOutput('''Statistics outputted are
-    #1. Generation number,
-    #2. population size (a list),
-    #3. number of segregation sites,
-    #4. average number of segregation sites per individual
-    #5. average allele frequency * 100
-    #6. average fitness value
-    #7. minimal fitness value of the parental population
-    #''', at = 0)] + \
-                [sim.IfElse(verbose >=0, ifOps=[sim.PyOutput('Starting stage %d\n' % i, at = Gens[i]) for i in range(0, len(Gens))])] + \
-                # add alleles from an existing population 
-                [sim.IfElse(extMutantFile != '',
-                    ifOps = [
-                        sim.PyOutput('Loading and converting population %s' % extMutantFile),
-                        sim.PyOperator(func=addMutantsFrom, param=(extMutantFile, regions, logger)),
-                    ], at = addMutantsAt),
-                # revert alleles at fixed loci to wildtype
-                RevertFixedSites(),
-                # mutate in a region at rate mu, if verbose > 2, save mutation events to a file
-                MutSpaceMutator(mu, ranges, {'finite_sites':1, 'infinite_sites':2}[mutationModel],
-                    output='' if verbose < 2 else '>>mutations.lst'),
-                # selection on all loci
-                mySelector,
-                # output statistics in verbose mode
-                # output stat to screen
-                sim.IfElse(verbose > 0, ifOps=[
-                    sim.Stat(popSize=True, meanOfInfo='fitness', minOfInfo='fitness'),
-                    NumSegregationSites(),
-                    sim.PyEval(r'"%5d %s %5d %.6f %.6f %.6f %.6f\n" '
-                        '% (gen, subPopSize, numSites, avgSites, avgFreq*100, meanOfInfo["fitness"], minOfInfo["fitness"])'
-                        ),
-                    ], at = progGen
-                ),
-                # output stat to file
-                sim.IfElse(statFile!='', ifOps=[
-                    sim.Stat(popSize=True, meanOfInfo='fitness', minOfInfo='fitness'),
-                    NumSegregationSites(),
-                    sim.PyEval(r'"%5d %s %5d %.6f %.6f %.6f %.6f\n" '
-                        '% (gen, subPopSize, numSites, avgSites, avgFreq*100, meanOfInfo["fitness"], minOfInfo["fitness"])',
-                        output='>>' + statFile),
-                    ], at = progGen
-                ),
-                sim.IfElse(len(splitTo) > 1,
-                    sim.Migrator(rate=migrIslandRates(migrRate, len(splitTo)),
-                        begin=splitAt + 1)
-                ),
-            ],
-            matingScheme=sim.RandomMating(ops=MutSpaceRecombinator(recRate, ranges),
-                subPopSize=multiStageDemoFunc(N, G, splitTo, splitAt)),
-            postOps = sim.SavePopulation(popFile[0], at=popFile[1]),
-            finalOps=[
-                # revert fixed sites so that the final population does not have fixed sites
-                RevertFixedSites(),
-                sim.IfElse(verbose > 0, ifOps=[
-                    # statistics after evolution
-                    sim.Stat(popSize=True),
-                    NumSegregationSites(),
-                    sim.PyEval(r'"%5d %s %5d %.6f %.6f %.6f %.6f\n" '
-                        '% (gen+1, subPopSize, numSites, avgSites, avgFreq*100, meanOfInfo["fitness"], minOfInfo["fitness"])',
-                        output='>>' + statFile),
-                    sim.PyEval(r'"Simulated population has %d individuals, %d segregation sites.'
-                               r'There are on average %.1f sites per individual. Mean allele frequency is %.4f%%.\n"'
-                               r'% (popSize, numSites, avgSites, avgFreq*100)'),
-                ]),
-            ],
-            gen = Gens[-1]
-        )
-    # if 'revertFixedSites is False':
-    else:
-        pop.evolve(
-            initOps=sim.InitSex(),
-            preOps=
-            #[
-    #            sim.PyOutput('''Statistics outputted are
-    #1. Generation number,
-    #2. population size (a list),
-    #3. number of segregation sites,
-    #4. average number of segregation sites per individual
-    #5. average allele frequency * 100
-    #6. average fitness value
-    #7. minimal fitness value of the parental population
-    #''', at = 0)] + \
-                [sim.IfElse(verbose >=0, ifOps=[sim.PyOutput('Starting stage %d\n' % i, at = Gens[i]) for i in range(0, len(Gens))])] + \
-                # add alleles from an existing population 
-                [sim.IfElse(extMutantFile != '',
-                    ifOps = [
-                        sim.PyOutput('Loading and converting population %s' % extMutantFile),
-                        sim.PyOperator(func=addMutantsFrom, param=(extMutantFile, regions, logger)),
-                    ], at = addMutantsAt),
-                # RevertFixedSites(),
-                # mutate in a region at rate mu, if verbose > 2, save mutation events to a file
-                MutSpaceMutator(mu, ranges, {'finite_sites':1, 'infinite_sites':2}[mutationModel],
-                    output='' if verbose < 2 else '>>mutations.lst'),
-                # selection on all loci
-                mySelector,
-                # output statistics in verbose mode
-                # output stat to screen
-                sim.IfElse(verbose > 0, ifOps=[
-                    sim.Stat(popSize=True, meanOfInfo='fitness', minOfInfo='fitness'),
-                    NumSegregationSites(),
-                    sim.PyEval(r'"%5d %s %5d %.6f %.6f %.6f %.6f\n" '
-                        '% (gen, subPopSize, numSites, avgSites, avgFreq*100, meanOfInfo["fitness"], minOfInfo["fitness"])'
-                        ),
-                    ], at = progGen
-                ),
-                # output stat to file
-                sim.IfElse(statFile!='', ifOps=[
-                    sim.Stat(popSize=True, meanOfInfo='fitness', minOfInfo='fitness'),
-                    NumSegregationSites(),
-                    sim.PyEval(r'"%5d %s %5d %.6f %.6f %.6f %.6f\n" '
-                        '% (gen, subPopSize, numSites, avgSites, avgFreq*100, meanOfInfo["fitness"], minOfInfo["fitness"])',
-                        output='>>' + statFile),
-                    ], at = progGen
-                ),
-                sim.IfElse(len(splitTo) > 1,
-                    sim.Migrator(rate=migrIslandRates(migrRate, len(splitTo)),
-                        begin=splitAt + 1)
-                ),
-            ],
-            matingScheme=sim.RandomMating(ops=MutSpaceRecombinator(recRate, ranges),
-                subPopSize=multiStageDemoFunc(N, G, splitTo, splitAt)),
-            postOps = sim.SavePopulation(popFile[0], at=popFile[1]),
-            finalOps=[
-                #RevertFixedSites(),
-                sim.IfElse(verbose > 0, ifOps=[
-                    # statistics after evolution
-                    sim.Stat(popSize=True),
-                    NumSegregationSites(),
-                    sim.PyEval(r'"%5d %s %5d %.6f %.6f %.6f %.6f\n" '
-                        '% (gen+1, subPopSize, numSites, avgSites, avgFreq*100, meanOfInfo["fitness"], minOfInfo["fitness"])',
-                        output='>>' + statFile),
-                    sim.PyEval(r'"Simulated population has %d individuals, %d segregation sites.'
-                               r'There are on average %.1f sites per individual. Mean allele frequency is %.4f%%.\n"'
-                               r'% (popSize, numSites, avgSites, avgFreq*100)'),
-                ]),
-            ],
-            gen = Gens[-1]
-        )
-    # end {if-else: revertFixedSites}
+        progGen.extend(xrange(Gens[i], Gens[i+1], steps[i]))
+    pop.evolve(
+        initOps=sim.InitSex(),
+        preOps=
+        #[
+#            sim.PyOutput('''Statistics outputted are
+#1. Generation number,
+#2. population size (a list),
+#3. number of segregation sites,
+#4. average number of segregation sites per individual
+#5. average allele frequency * 100
+#6. average fitness value
+#7. minimal fitness value of the parental population
+#''', at = 0)] + \
+            [sim.IfElse(verbose >=0, ifOps=[sim.PyOutput('Starting stage %d\n' % i, at = Gens[i]) for i in range(0, len(Gens))])] + \
+            # add alleles from an existing population 
+            [sim.IfElse(extMutantFile != '',
+                ifOps = [
+                    sim.PyOutput('Loading and converting population %s' % extMutantFile),
+                    sim.PyOperator(func=addMutantsFrom, param=(extMutantFile, regions, logger)),
+                ], at = addMutantsAt),
+            # if 'revertFixedSites is True', revert alleles at fixed loci to wildtype
+            sim.IfElse(bool(revertFixedSites), ifOps=[RevertFixedSites()]),
+            # mutate in a region at rate mu, if verbose > 2, save mutation events to a file
+            MutSpaceMutator(mu, ranges, {'finite_sites':1, 'infinite_sites':2}[mutationModel],
+                output='' if verbose < 2 else '>>mutations.lst'),
+            # selection on all loci
+            mySelector,
+            # output statistics in verbose mode
+            # output stat to screen
+            sim.IfElse(verbose > 0, ifOps=[
+                sim.Stat(popSize=True, meanOfInfo='fitness', minOfInfo='fitness'),
+                NumSegregationSites(),
+                sim.PyEval(r'"%5d %s %5d %.6f %.6f %.6f %.6f\n" '
+                    '% (gen, subPopSize, numSites, avgSites, avgFreq*100, meanOfInfo["fitness"], minOfInfo["fitness"])'
+                    ),
+                ], at = progGen
+            ),
+            # output stat to file
+            sim.IfElse(statFile!='', ifOps=[
+                sim.Stat(popSize=True, meanOfInfo='fitness', minOfInfo='fitness'),
+                NumSegregationSites(),
+                sim.PyEval(r'"%5d %s %5d %.6f %.6f %.6f %.6f\n" '
+                    '% (gen, subPopSize, numSites, avgSites, avgFreq*100, meanOfInfo["fitness"], minOfInfo["fitness"])',
+                    output='>>' + statFile),
+                ], at = progGen
+            ),
+            sim.IfElse(len(splitTo) > 1,
+                sim.Migrator(rate=cachedMigrRates(migrRate, len(splitTo)),
+                    begin=splitAt + 1)
+            ),
+        ],
+        matingScheme=sim.RandomMating(ops=MutSpaceRecombinator(recRate, ranges),
+            subPopSize=cachedDemoFunc(N, G, splitTo, splitAt, Gens)),
+        postOps = sim.SavePopulation(popFile[0], at=popFile[1]),
+        finalOps=[
+            # revert fixed sites so that the final population does not have fixed sites
+            sim.IfElse(bool(revertFixedSites), ifOps=[RevertFixedSites()]),
+            sim.IfElse(verbose > 0, ifOps=[
+                # statistics after evolution
+                sim.Stat(popSize=True),
+                NumSegregationSites(),
+                sim.PyEval(r'"%5d %s %5d %.6f %.6f %.6f %.6f\n" '
+                    '% (gen+1, subPopSize, numSites, avgSites, avgFreq*100, meanOfInfo["fitness"], minOfInfo["fitness"])',
+                    output='>>' + statFile),
+                sim.PyEval(r'"Simulated population has %d individuals, %d segregation sites.'
+                           r'There are on average %.1f sites per individual. Mean allele frequency is %.4f%%.\n"'
+                           r'% (popSize, numSites, avgSites, avgFreq*100)'),
+            ]),
+        ],
+        gen = Gens[-1]
+    )
     # record selection coefficients to population
     if len(collector.selCoef) == 0:
         # this must be the neutral case where a NonOp has been used.
@@ -1201,11 +1283,12 @@ def simuRareVariants(regions, N, G, mu, revertFixedSites, selDist, selCoef,
         pop.dvars().selCoef = collector.selCoef
     #
     if logger:
-        logger.info('Population simulation takes %.2f seconds' % (time.clock() - startTime))
+        logger.info('Population simulation takes %.2f seconds' % (timer() - startTime))
     if logger:
-        logger.info('Saving marker information to file %s' % markerFile)
+        logger.info('Saving marker information to file %s' % getattr(markerFile, 'name', markerFile))
     # write mutants info to *.sfs file
-    mutants, maf, sel, pos, vaf = saveMarkerInfoToFile(pop, markerFile, regInt, replicate, logger)   
+    mutants, maf, sel, pos, vaf = saveMarkerInfoToFile(pop, markerFile, regInt, replicate, logger,
+        selTable=(collector.start, collector.selS) if len(collector.selCoef) > 0 and collector.selS is not None else None)
     genos = None
     #if variantPool or genotypeFile:
     #    if logger:
@@ -1218,21 +1301,118 @@ def simuRareVariants(regions, N, G, mu, revertFixedSites, selDist, selCoef,
     return pop, genos, maf, sel, pos, vaf
 
 
+def simulateReplicate(num, regRange, N, G, mu, revertFixedSites, selDist, selCoef,
+        selModel, selRange, recRate, steps, mutationModel, verbose,
+        genotypeFile='', statFile='', variantPool=False, markerFile='', seed=None):
+    '''Simulate replicate ``num`` and write its marker information to file
+    markerFile.sfs, which is created or truncated (or append it to markerFile
+    if it is an opened file). If ``seed`` is given, random number generators are seeded with it so that replicates
+    simulated in different (forked) processes are independent. Return time
+    (in seconds) spent on this replicate.
+    '''
+    if seed is not None:
+        random.seed(seed)
+        sim.getRNG().set(seed=seed)
+    startTime = timer()
+    regInt = random.randint(regRange[0], regRange[1])
+    regions = ['chr1:1..'+ str(regInt)]
+    #
+    if verbose in [0,1]:
+        print('Begin to simulate replicate #', num)
+        print('Gene length of current replicate = ', regInt)
+    #
+    if verbose == 1 and num == 1:
+        print('''Statistics outputted are
+1. Generation number,
+2. population size (a list),
+3. number of segregation sites,
+4. average number of segregation sites per individual
+5. average allele frequency * 100
+6. average fitness value
+7. minimal fitness value of the parental population
+                ''')
+    if hasattr(markerFile, 'write'):
+        sfsFile = markerFile
+    else:
+        # output of this replicate only, so that a file left by an earlier
+        # (e.g. failed or repeated) run is overwritten instead of appended to
+        sfsFile = open(markerFile+'.sfs', 'w', BUFFER_SIZE)
+    try:
+        pop, genos, maf, sel, pos, vaf = simuRareVariants(regions=regions, N=N, G=G, mu=mu, revertFixedSites=revertFixedSites, selDist=selDist,
+                           selCoef=selCoef, selModel=selModel, selRange=selRange, recRate=recRate,
+                           steps=steps, mutationModel=mutationModel, verbose=verbose,
+                           genotypeFile=genotypeFile, statFile=statFile, variantPool=variantPool, regInt=regInt, replicate=num, markerFile=sfsFile)
+    finally:
+        if sfsFile is not markerFile:
+            sfsFile.close()
+    
+    
+    #if variantPool:
+    #    cwd = os.getcwd()
+    #    os.chdir(tempFolder)
+    #    haplotypes = convertGenosToListOf2Haps(genos, vaf)
+    #    obj = GData(data={'rep'+str(num):haplotypes, 'maf':maf, 'annotation':sel, 'position':pos}, name='rep'+str(num))
+    #    obj.compress()
+    #    obj.sink('rep'+str(num))
+    #    del obj
+    #    os.chdir(cwd)
+    #    #dictGenos[str(num)] = np.array(genos, dtype=np.uint8)
+    ## remove unused objects
+    #del pop, genos, maf, sel, pos, vaf
+    return timer() - startTime
+
+
+def replicateSeeds(seed, numReps):
+    '''Return distinct seeds of replicates 1, ..., numReps derived from
+    ``seed`` (a random seed from random.SystemRandom if None). A given seed
+    always gives the same seed to each replicate, no matter whether replicates
+    are simulated together or as separate jobs.
+    '''
+    if seed is None:
+        seed = random.SystemRandom().getrandbits(64)
+    rng = random.Random(seed)
+    # sampling without replacement so that no two replicates share a seed
+    return rng.sample(xrange(1, 2**31), numReps)
+
+
+def mergeSfsFiles(fileName, numReps):
+    '''Merge files fileName_rep_i.sfs (i = 1, ..., numReps) written by
+    replicates simulated in separate processes or jobs into fileName.sfs and
+    remove them. Nothing is written or removed if any of these files is
+    missing, and fileName.sfs is only replaced after all files are merged.
+    '''
+    repFiles = [fileName+'_rep_'+str(num)+'.sfs' for num in range(1, numReps+1)]
+    missing = [x for x in repFiles if not os.path.isfile(x)]
+    if missing:
+        raise ValueError('Cannot merge replicates into %s.sfs because %d file(s) are missing: %s'
+            % (fileName, len(missing), ', '.join(missing)))
+    tmpName = fileName+'.sfs.tmp'
+    with open(tmpName, 'w', BUFFER_SIZE) as outFile:
+        print('#name chr position maf annotation', file=outFile)
+        for repFile in repFiles:
+            with open(repFile) as inFile:
+                shutil.copyfileobj(inFile, outFile)
+    # os.rename replaces an existing file atomically on POSIX systems
+    if os.name == 'nt' and os.path.isfile(fileName+'.sfs'):
+        os.remove(fileName+'.sfs')
+    os.rename(tmpName, fileName+'.sfs')
+    for repFile in repFiles:
+        os.remove(repFile)
+    return
+
+
 def srvOutput(regRange, fileName, numReps, N, G, mu, revertFixedSites, selDist, selCoef,
               selModel, selRange, recRate, steps, mutationModel, verbose,
-              saveGenotype=0, saveStat=0, variantPool=False
+              saveGenotype=0, saveStat=0, variantPool=False, numJobs=1, repID=0, seed=None
    # initPop='', extMutantFile='', addMutantsAt=0, splitTo=[1], splitAt=0, migrRate=0,
    # statFile='', popFile='', markerFile='', mutantFile='', genotypeFile='',
    # verbose=1, logger=None
     ):
     '''
+    If repID > 0, only replicate repID is simulated and its output is written
+    to fileName_rep_repID.sfs, so that replicates can be run as independent
+    (e.g. cluster) jobs with the same seed and merged by mergeSfsFiles.
     '''
-    # write the following to fileName.sfs, gene length, mafs, sels and pos info
-    #
-    outFile = open(fileName+'.sfs', 'w')
-    print >> outFile, '#name chr position maf annotation'
-    outFile.close()
-    #
     # check if need to output genotype and statistics to files
     if saveGenotype == -1:
         saveGenoNum = range(1, numReps+1)
@@ -1255,59 +1435,53 @@ def srvOutput(regRange, fileName, numReps, N, G, mu, revertFixedSites, selDist,
         else:
             dicSaveStat[i] = ''
     #
-    startTime = [0]
-    endTime = [0]
-    dictGenos = {}
+    # one seed per replicate
+    # seed 0 (the default of option seed and of configuration files) means
+    # no seed, as for other subcommands
+    seeds = replicateSeeds(seed if seed else None, max(numReps, repID))
+    pars = dict(regRange=regRange, N=N, G=G, mu=mu, revertFixedSites=revertFixedSites, selDist=selDist,
+                selCoef=selCoef, selModel=selModel, selRange=selRange, recRate=recRate,
+                steps=steps, mutationModel=mutationModel, verbose=verbose, variantPool=variantPool)
+    if repID > 0:
+        simulateReplicate(repID, genotypeFile=dicSaveGeno.get(repID, ''), statFile=dicSaveStat.get(repID, ''),
+            markerFile=fileName+'_rep_'+str(repID), seed=seeds[repID-1], **pars)
+        return
+    totalTime = 0.
     # create a temporary folder
     if variantPool:
         tempFolder = tempfile.mkdtemp()
     # run for multiple replicates
-    for idx, num in enumerate(range(1, numReps+1)):
-        random.seed(time.time())
-        startTime.append(time.clock())
-        regInt = random.randint(regRange[0], regRange[1])
-        regions = ['chr1:1..'+ str(regInt)]
-        #
-        if verbose in [0,1]:
-            print 'Begin to simulate replicate #', num
-            print 'Gene length of current replicate = ', regInt
-        #
-        if verbose == 1 and num == 1:
-            print('''Statistics outputted are
-1. Generation number,
-2. population size (a list),
-3. number of segregation sites,
-4. average number of segregation sites per individual
-5. average allele frequency * 100
-6. average fitness value
-7. minimal fitness value of the parental population
-                ''')
-        pop, genos, maf, sel, pos, vaf = simuRareVariants(regions=regions, N=N, G=G, mu=mu, revertFixedSites=revertFixedSites, selDist=selDist,
-                               selCoef=selCoef, selModel=selModel, selRange=selRange, recRate=recRate,
-                               steps=steps, mutationModel=mutationModel, verbose=verbose,
-                               genotypeFile=dicSaveGeno[num], statFile=dicSaveStat[num], variantPool=variantPool, regInt=regInt, replicate=idx+1, markerFile=fileName)
-        
-        
-        #if variantPool:
-        #    cwd = os.getcwd()
-        #    os.chdir(tempFolder)
-        #    haplotypes = convertGenosToListOf2Haps(genos, vaf)
-        #    obj = GData(data={'rep'+str(num):haplotypes, 'maf':maf, 'annotation':sel, 'position':pos}, name='rep'+str(num))
-        #    obj.compress()
-        #    obj.sink('rep'+str(num))
-        #    del obj
-        #    os.chdir(cwd)
-        #    #dictGenos[str(num)] = np.array(genos, dtype=np.uint8)
-        endTime.append(time.clock())
-        if verbose == -1:
-            continue
-        else:
-            print 'Finished simulating replicate #', num
-            print 'Time spent for simulating current replicate = ', round((endTime[num]-startTime[num])/60, 1), 'minutes'
-            print 'Total time spent = ', round((sum(endTime)-sum(startTime))/60, 1), 'minutes'
-            print '----------------------------------------------------------------------'
-        ## remove unused objects
-        #del pop, genos, maf, sel, pos, vaf
+    if numJobs == 1:
+        # write the following to fileName.sfs, gene length, mafs, sels and pos info
+        # the file is kept open (and buffered) while all replicates are simulated
+        with open(fileName+'.sfs', 'w', BUFFER_SIZE) as outFile:
+            print('#name chr position maf annotation', file=outFile)
+            for num in range(1, numReps+1):
+                repTime = simulateReplicate(num, genotypeFile=dicSaveGeno[num], statFile=dicSaveStat[num],
+                    markerFile=outFile, seed=seeds[num-1], **pars)
+                totalTime += repTime
+                if verbose == -1:
+                    continue
+                else:
+                    print('Finished simulating replicate #', num)
+                    print('Time spent for simulating current replicate = ', round(repTime/60, 1), 'minutes')
+                    print('Total time spent = ', round(totalTime/60, 1), 'minutes')
+                    print('----------------------------------------------------------------------')
+    else:
+        # replicates are independent, each process writes to its own *_rep_i.sfs
+        startTime = timer()
+        repTimes = Parallel(n_jobs=numJobs, verbose=5 if verbose == 1 else 0, backend="multiprocessing")(
+            delayed(simulateReplicate)(num, genotypeFile=dicSaveGeno[num], statFile=dicSaveStat[num],
+                markerFile=fileName+'_rep_'+str(num), seed=seeds[num-1], **pars)
+            for num in range(1, numReps+1))
+        # wall time, replicates of different processes overlap
+        totalTime = timer() - startTime
+        mergeSfsFiles(fileName, numReps)
+        if verbose != -1:
+            print('Finished simulating %d replicates' % numReps)
+            print('Total time spent = ', round(totalTime/60, 1), 'minutes')
+            print('Sum of time spent on each replicate = ', round(sum(repTimes)/60, 1), 'minutes')
+            print('----------------------------------------------------------------------')
     # save genotype of individuals of different replicates into outfile.gdat by numpy.uint8 format
     if variantPool:
         bz2Save(fileName, tempFolder)
@@ -1334,25 +1508,12 @@ def convertGenosToListOf2Haps(genos, vaf):
     '''
     convert genotype to haplotypes and swap wild-tyes with variants (0<->1) if variant allele frequency > 0.5
     '''
-    haps = []
-    lenHap = len(genos[0])/2
-    for geno in genos:
-        hap1, hap2 = [], []
-        for i in range(lenHap):
-            hap1.append(geno[i*2]), hap2.append(geno[(i*2)+1])
-        haps.append(hap1)
-        haps.append(hap2)
-    #
-    hapsArray = np.array(haps)
-    for idx, f in enumerate(vaf):
-        if f > 0.5:
-            for i,x in enumerate(hapsArray[:,idx]):
-                if x == 0:
-                    hapsArray[i, idx] = 1
-                elif x == 1:
-                    hapsArray[i, idx] = 0
-                else:
-                    continue
+    # genos holds one row per individual with the two alleles of each marker
+    # in adjacent columns, which is split into two rows of haplotypes
+    genos = np.asarray(genos, dtype=np.uint8)
+    hapsArray = genos.reshape(genos.shape[0], -1, 2).transpose(0, 2, 1).reshape(2*genos.shape[0], -1)
+    # genotypes are coded 0/1 so swapping is a XOR with 1
+    hapsArray[:, np.asarray(vaf) > 0.5] ^= 1
     return hapsArray
 
 
@@ -1361,12 +1522,15 @@ def bz2Save(fileName, tempFolder):
     zip 'rep#' files in tempFolder to fileName and delete tempFolder
     '''
     repNames = glob.glob(os.path.join(tempFolder, '*'))
-    tar = tarfile.open(fileName+'.gdat', 'w:bz2')
+    # gzip at level 1 is several times faster than bz2 at level 9, and
+    # readers (GFile.open) detect the compression method automatically
+    tar = tarfile.open(fileName+'.gdat', 'w:gz', compresslevel=1)
     cwd = os.getcwd()
     os.chdir(tempFolder)
     for name in repNames:
         #tar.add(name)
         tar.add(os.path.basename(name))
+    tar.close()
     # remove tempFolder
     shutil.rmtree(tempFolder)
     os.chdir(cwd)
@@ -1383,4 +1547,5 @@ if __name__ == '__main__':
                   selModel=pars.selModel, selDist=pars.selDist, selCoef=pars.selCoef, selRange=pars.selRange,
                     recRate=pars.recRate, steps=pars.steps, verbose=pars.verbose,
                     saveGenotype=pars.saveGenotype, saveStat=pars.saveStat,
-                    revertFixedSites=pars.revertFixedSites, variantPool=pars.variantPool)
+                    revertFixedSites=pars.revertFixedSites, variantPool=pars.variantPool,
+                    numJobs=pars.numJobs, repID=pars.repID, seed=pars.seed if pars.seed else None)